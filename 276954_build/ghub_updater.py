@@ -3,10 +3,55 @@
 from libraries.components import Websocket
 from libraries.process import Application
 from libraries.utilities import process
+from concurrent.futures import ThreadPoolExecutor
 import argparse
-import json
+import logging
 import time
 
+try:
+    import orjson
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+except ImportError:
+    from json import dumps, loads
+
+RECOVERABLE_ERRORS = (TimeoutError, ConnectionError, RuntimeError)
+BANNER_FORMAT = "\n========================================= %s ========================================="
+SEPARATOR = "=" * 104
+BUILD_INFO_KEYS = (('channel', 'CHANNEL'), ('version', 'VERSION'), ('buildId', 'BUILDID'), ('branch', 'BRANCH'))
+TERMINAL_ERRORS = (PermissionError, FileNotFoundError, NotImplementedError)
+UPDATE_STATES = frozenset(("CHECKING_FOR_UPDATES", "UPDATE_DOWNLOADING", "UPDATE_UNPACKING", "UPDATE_READY"))
+
+logger = logging.getLogger('ghub_updater')
+
+
+def _poll_until(predicate, max_time=10, initial=0.1, cap=1.0) -> bool:
+    """
+    Poll the predicate with exponential backoff until it returns a truthy value or max_time elapses.
+    Return True as soon as predicate is satisfied else False. Exceptions raised by predicate are
+    treated as "not ready yet".
+    predicate: callable = Readiness check
+    max_time: int = Maximum seconds to wait
+    initial: float = First poll interval in seconds
+    cap: float = Maximum poll interval in seconds
+    """
+    deadline = time.monotonic() + max_time
+    interval = initial
+    while True:
+        try:
+            if predicate():
+                return True
+        except Exception:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(cap, interval * 1.5)
+
 
 class GhubUpdater:
     """
@@ -18,56 +63,117 @@ class GhubUpdater:
         self.app = Application()
         self.app.control_lghub()
         self.backend = Websocket()
+        self._resp_cache = dict()
+        self._launched = False
+        self._downloaded = None
+        self._executor = None
 
     def launch_ghub(self, retry=5) -> None:
         """
         Close and launch the G-HUB application.
+        Failed attempts are retried with exponential backoff, errors which can't be fixed by retrying are raised
+        immediately.
         retry: int = Number of times to retry to launch the G-HUB
-        retry_interval_time: int = Time seconds to wait before retry
         """
         for number in range(retry):
             try:
                 self.app.terminate_all(True)
-                time.sleep(10)
+                if not _poll_until(lambda: self.backend.process.is_not_running is True, max_time=15):
+                    raise TimeoutError("G-HUB backend is still running after terminate")
                 self.app.launch_all(True)
-                print("[INFO]: G-HUB launched successfully")
+                if not _poll_until(lambda: self.backend.process.is_not_running is None, max_time=30):
+                    raise TimeoutError("G-HUB backend is not connected after launch")
+                logger.info("G-HUB launched successfully")
                 break
+            except TERMINAL_ERRORS:
+                raise
             except Exception as exception:
-                print("[EXCEPTION]: ", exception)
-                print("[WARNING]: G-HUB doesn't launching. [{}] Retrying again...".format(number + 1))
+                logger.error("Exception: %s", exception)
+                logger.warning("G-HUB doesn't launching. [%d] Retrying again...", number + 1)
+                if number + 1 < retry:
+                    time.sleep(min(30, 2 ** number))
         else:
-            msg = "[ERROR]: Unable to launch the G-HUB"
-            print(msg)
+            msg = "Unable to launch the G-HUB"
+            logger.error(msg)
             raise RuntimeError(msg)
 
+    def _ensure_ready(self) -> None:
+        """
+        Launch the G-HUB only if it has not been launched yet or its backend is not running anymore.
+        """
+        if not self._launched or self.backend.process.is_not_running:
+            self.launch_ghub()
+            self._launched = True
+
     def get_build_info(self) -> dict:
         """
         Return current build information data such as channel name, build id and version.
         """
         build_info = dict()
-        self.backend.send_message(verb='GET', path="/updates/channel")
-        response = json.loads(self.backend.get_message_response_from_bulk('GET', '/updates/channel'))
-        build_info['channel'] = response['payload']['name']
-        self.backend.send_message(verb='GET', path="/updates/info")
-        response = json.loads(self.backend.get_message_response_from_bulk('GET', '/updates/info'))
-        build_info['version'] = response['payload']['version']
-        build_info['buildId'] = response['payload']['buildId']
-        build_info['branch'] = response['payload']['branch']
+        channel, info = self._cached_get('/updates/channel', '/updates/info')
+        build_info['channel'] = channel['name']
+        build_info['version'] = info['version']
+        build_info['buildId'] = info['buildId']
+        build_info['branch'] = info['branch']
         return build_info
 
+    def _receive(self, verb, path, timeout=None) -> dict:
+        """
+        Read the response of an already sent request and return its parsed payload.
+        """
+        if timeout is None:
+            response = self.backend.get_message_response_from_bulk(verb, path)
+        else:
+            response = self.backend.get_message_response_from_bulk(verb, path, timeout=timeout)
+        return loads(response)['payload']
+
+    def _request(self, verb, path, *, timeout=None, **kwargs) -> dict:
+        """
+        Send a request and return the parsed payload of its response.
+        """
+        self.backend.send_message(verb=verb, path=path, **kwargs)
+        return self._receive(verb, path, timeout=timeout)
+
+    def _cached_get(self, *paths, ttl=5.0) -> list:
+        """
+        Return the parsed GET payloads of the given paths in the same order.
+        Responses younger than ttl seconds are served from the cache, the rest are requested together.
+        """
+        now = time.monotonic()
+        stale = [path for path in paths if path not in self._resp_cache or now - self._resp_cache[path][0] >= ttl]
+        for path in stale:
+            self.backend.send_message(verb='GET', path=path)
+        for path in stale:
+            self._resp_cache[path] = (time.monotonic(), self._receive('GET', path))
+        return [self._resp_cache[path][1] for path in paths]
+
+    def _set(self, path, **kwargs) -> None:
+        """
+        Send a SET request and drop the cached responses it makes stale.
+        Installing a build changes every cached path, so it clears the whole cache.
+        """
+        if path == '/updates/install':
+            self._resp_cache.clear()
+        else:
+            self._resp_cache.pop(path, None)
+        self.backend.send_message(verb='SET', path=path, **kwargs)
+
+    def _status(self, timeout=None) -> str:
+        """
+        Return the current update state reported by the backend.
+        """
+        return self._request('GET', '/updates/status', timeout=timeout)['state']
+
     def reset_existing_update_process(self) -> None:
         """
         Reset the G-HUB update process and relaunch the G_HUB if already update process running
         """
-        update_states = ["CHECKING_FOR_UPDATES", "UPDATE_DOWNLOADING", "UPDATE_UNPACKING", "UPDATE_READY"]
-        self.backend.send_message(verb='GET', path='/updates/status')
-        response = json.loads(self.backend.get_message_response_from_bulk('GET', '/updates/status', timeout=60))
-        if response['payload']['state'] in update_states:
-            print("[INFO]: Resetting existing update process")
-            self.backend.send_message(verb='SET', path='/updates/reset')
-            self.backend.send_message(verb='SET', path='/updates/purge')
+        if self._status(timeout=60) in UPDATE_STATES:
+            logger.info("Resetting existing update process")
+            self._set('/updates/reset')
+            self._set('/updates/purge')
+            _poll_until(lambda: self._status(timeout=5) not in UPDATE_STATES, max_time=10)
             process.kill("lghub_updater")
-            time.sleep(10)
             self.launch_ghub()
 
     def set_channel(self, channel_name: str, password: str = '', access_tokens: str = '') -> None:
@@ -78,164 +184,213 @@ class GhubUpdater:
         """
         path = '/updates/channel'
         channel_name = channel_name.strip()
-        json_data = json.dumps({"name": channel_name, "password": password})
-        self.backend.send_message(verb='SET', path=path, json=json_data)
-        self.backend.send_message(verb='GET', path=path)
-        response = json.loads(self.backend.get_message_response_from_bulk('GET', path))
-        if response['payload']['name'] == channel_name:
-            print("[INFO]: [{}] channel has been set successfully".format(channel_name))
+        json_data = dumps({"name": channel_name, "password": password})
+        self._set(path, json=json_data)
+        payload = self._cached_get(path)[0]
+        if payload['name'] == channel_name:
+            logger.info("[%s] channel has been set successfully", channel_name)
         else:
-            msg = "[ERROR]: Given channel is [{}] but [{}] channel has been set"
-            print(msg.format(channel_name, response['payload']['name']))
-            raise RuntimeError(msg.format(channel_name, response['payload']['name']))
+            msg = "Given channel is [%s] but [%s] channel has been set"
+            logger.error(msg, channel_name, payload['name'])
+            raise RuntimeError(msg % (channel_name, payload['name']))
 
     def check_for_update(self):
         """
         Description: Check for update and return new version if update is available else False.
         Raise an error if there is UPDATER_ERROR.
         """
-        self.backend.send_message(verb='SET', path='/updates/reset')
-        self.backend.send_message(verb='SET', path='/updates/check_now')
-        print("[INFO]: Checking for new updates...")
-        time.sleep(10)
-        self.backend.send_message(verb='GET', path='/updates/status')
-        response = json.loads(self.backend.get_message_response_from_bulk('GET', '/updates/status', timeout=60))
-        update_state = response['payload']['state']
+        self._set('/updates/reset')
+        self._set('/updates/check_now')
+        logger.info("Checking for new updates...")
+        update_state = None
+        checking_seen = False
+        started = time.monotonic()
+
+        def check_finished():
+            nonlocal update_state, checking_seen
+            update_state = self._status(timeout=5)
+            if update_state == "CHECKING_FOR_UPDATES":
+                checking_seen = True
+                return False
+            # First probes may still read the state left from before check_now, so a final state only counts
+            # once the check was seen running or the previous 10 seconds settle time has passed.
+            return checking_seen or (update_state != "IDLE" and time.monotonic() - started >= 10)
+
+        if not _poll_until(check_finished, max_time=60) and update_state is None:
+            update_state = self._status(timeout=5)
         if update_state == 'UPDATER_ERROR':
-            msg = "[ERROR]: There is updater error in G-HUB. Please check channel name, password and token"
-            print(msg)
+            msg = "There is updater error in G-HUB. Please check channel name, password and token"
+            logger.error(msg)
             raise RuntimeError(msg)
         elif update_state == "CHECKING_FOR_UPDATES":
-            msg = "[ERROR]: Taking long time for checking updates"
-            print(msg)
+            msg = "Taking long time for checking updates"
+            logger.error(msg)
             process.kill("lghub_updater")
             time.sleep(10)
             raise RuntimeError(msg)
+        elif update_state == "IDLE":
+            msg = "Check for updates did not start"
+            logger.error(msg)
+            raise RuntimeError(msg)
         elif update_state == 'NO_UPDATES':
             return False
         else:
-            self.backend.send_message(verb='GET', path='/updates/next/info')
-            response = json.loads(self.backend.get_message_response_from_bulk('GET', '/updates/next/info'))
-            return response['payload']['version']
+            return self._request('GET', '/updates/next/info')['version']
 
     def download_new_update(self) -> None:
         """
         Download the new update and wait until new update is ready for install.
         """
-        self.backend.send_message(verb='SET', path='/updates/download')
-        print("[INFO]: Downloading new updates. Please wait...")
+        self._set('/updates/download')
+        logger.info("Downloading new updates. Please wait...")
+        self._wait_for_download()
+
+    def download_new_update_async(self):
+        """
+        Start downloading the new update and return a Future which completes when the update is ready for install.
+        The backend must not be used by the caller until the Future is done.
+        """
+        self._set('/updates/download')
+        logger.info("Downloading new updates in background...")
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor.submit(self._wait_for_download)
+
+    def close(self) -> None:
+        """
+        Shut down the background download worker, waiting for a running download wait to finish.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _wait_for_download(self) -> None:
+        """
+        Wait until the new update is ready for install. Raise TimeoutError if download is not completed.
+        """
         try:
             self.wait_for_update_state("UPDATE_READY")
-            print("[INFO]: Update ready to install...")
+            logger.info("Update ready to install...")
         except Exception as exception:
-            print("[EXCEPTION]: ", exception)
-            msg = "[ERROR]: Downloading not completed. Taking long time to download"
-            print(msg)
+            logger.error("Exception: %s", exception)
+            msg = "Downloading not completed. Taking long time to download"
+            logger.error(msg)
             raise TimeoutError(msg)
 
-    def install_new_update(self) -> None:
+    def install_new_update(self) -> str:
         """
-        Start installation process and wait until complete it.
+        Start installation process, wait until complete it and return the installed version.
         """
         try:
-            self.backend.send_message(verb='SET', path='/updates/install')
+            self._set('/updates/install')
         except Exception as exception:
-            print("[EXCEPTION]: ", exception)
-            print("[WARNING]: Install process may not be started. Please make sure G-HUB updated properly")
-        print("[INFO]: Installing new updates. Please wait...")
+            logger.error("Exception: %s", exception)
+            logger.warning("Install process may not be started. Please make sure G-HUB updated properly")
+        logger.info("Installing new updates. Please wait...")
         self.wait_until_backend_disconnected()
         self.wait_until_backend_connected()
-        time.sleep(20)
-        if self.check_for_update():
-            msg = "[ERROR]: New update installation not completed properly. Please check the G-HUB"
-            print(msg)
-            raise RuntimeError(msg)
-        print("[INFO]: New update installed successfully...")
+        _poll_until(lambda: self._status() in ("IDLE", "NO_UPDATES"), max_time=20)
+        return self._cached_get('/updates/info')[0]['version']
 
     def wait_until_backend_connected(self, max_time=600):
         """
         Description: Wait for backend connect. Return True if backend connected within given max time
         else raise the TimeoutError error
         """
-        start_time = time.time()
-        end_time = start_time + max_time
-        while end_time > time.time():
+        deadline = time.monotonic() + max_time
+        while time.monotonic() < deadline:
             status = self.backend.process.is_not_running
             if status is None:
                 return True
-        else:
-            msg = "[ERROR]: Waited for {} seconds to connect the backend, but it's not connected"
-            print(msg.format(max_time))
-            raise TimeoutError(msg.format(max_time))
+            time.sleep(0.05)
+        msg = "Waited for %s seconds to connect the backend, but it's not connected"
+        logger.error(msg, max_time)
+        raise TimeoutError(msg % max_time)
 
     def wait_until_backend_disconnected(self, max_time=600):
         """
         Description: Wait for backend disconnect. Return True if backend disconnected within given max time
         else raise the TimeoutError error
         """
-        start_time = time.time()
-        end_time = start_time + max_time
-        while end_time > time.time():
+        deadline = time.monotonic() + max_time
+        while time.monotonic() < deadline:
             status = self.backend.process.is_not_running
             if status is True:
                 return True
-        else:
-            msg = "[ERROR]: Waited for {} seconds to disconnect the backend, but it's still connected"
-            print(msg.format(max_time))
-            raise TimeoutError(msg.format(max_time))
+            time.sleep(0.05)
+        msg = "Waited for %s seconds to disconnect the backend, but it's still connected"
+        logger.error(msg, max_time)
+        raise TimeoutError(msg % max_time)
 
     def wait_for_update_state(self, expected_state, max_time=600):
         """
-        Description: Wait for server disconnect. Return True if server is disconnected within given max time else False
+        Description: Wait for the update state. Return True if expected state is reached within given max time
+        else raise the RuntimeError error
         """
-        start_time = time.time()
-        end_time = start_time + max_time
-        while end_time > time.time():
-            if self.backend.process.is_not_running:
-                continue
-            try:
-                self.backend.send_message(verb='GET', path='/updates/status')
-                response = json.loads(self.backend.get_message_response_from_bulk('GET', '/updates/status'))
-                state = response['payload']['state']
-                if state == expected_state:
-                    return True
-            except Exception as exception:
-                print("[EXCEPTION]: ", exception)
-                continue
-        else:
-            msg = "[ERROR]: Unable to get the [{}] update state".format(expected_state)
-            print(msg)
-            raise RuntimeError(msg)
+        last_logged = dict()
+        interval = 0.5
+        deadline = time.monotonic() + max_time
+        while time.monotonic() < deadline:
+            if not self.backend.process.is_not_running:
+                try:
+                    if self._status() == expected_state:
+                        return True
+                except Exception as exception:
+                    name = type(exception).__name__
+                    now = time.monotonic()
+                    if name not in last_logged or now - last_logged[name] >= 5:
+                        last_logged[name] = now
+                        logger.debug("Exception while reading the update state: %s", exception)
+            time.sleep(interval)
+            interval = min(5, interval * 2)
+        msg = "Unable to get the [%s] update state"
+        logger.error(msg, expected_state)
+        raise RuntimeError(msg % expected_state)
 
     def print_build_info(self, title):
         """
         Print the build information
         """
         build_info = self.get_build_info()
-        print("\n========================================= {} =========================================".format(title))
-        for key, value in build_info.items():
-            print("{}: {}".format(key.upper(), value))
-        print("=" * 104)
-        print("\n")
+        logger.info(BANNER_FORMAT, title)
+        for key, label in BUILD_INFO_KEYS:
+            logger.info("%s: %s", label, build_info[key])
+        logger.info(SEPARATOR)
 
-    def start(self, channel_name: str, password: str = '', access_tokens: str = '') -> None:
+    def start(self, channel_name: str, password: str = '', access_tokens: str = '', resume: bool = False) -> None:
         """
         This is main method to start the update process.
+        resume: bool = Retry of a failed attempt. If that attempt already downloaded an update for this channel
+        and it is still ready to install, the download steps are skipped.
         """
-        self.launch_ghub()
-        self.reset_existing_update_process()
-        self.print_build_info("CURRENT BUILD INFO")
-        self.set_channel(channel_name, password, access_tokens)
-        new_version = self.check_for_update()
+        channel_name = channel_name.strip()
+        downloaded = self._downloaded if resume else None
+        self._downloaded = None
+        self._ensure_ready()
+        if downloaded and downloaded[0] == channel_name and self._status(timeout=60) == 'UPDATE_READY':
+            new_version = downloaded[1]
+            logger.info("Resuming installation of already downloaded version %s", new_version)
+        else:
+            self.reset_existing_update_process()
+            self.print_build_info("CURRENT BUILD INFO")
+            self.set_channel(channel_name, password, access_tokens)
+            new_version = self.check_for_update()
+            if new_version:
+                self.download_new_update()
+                self._downloaded = (channel_name, new_version)
         if new_version:
-            self.download_new_update()
-            self.install_new_update()
-            if new_version == self.get_build_info()['version']:
-                print("[INFO]: New G-HUB version {0} is updated successfully...".format(new_version))
-                self.print_build_info("NEW BUILD INFO")
+            installed_version = self.install_new_update()
+            if installed_version != new_version:
+                msg = "New update installation not completed properly. Expected version [%s] but [%s] is installed"
+                logger.error(msg, new_version, installed_version)
+                raise RuntimeError(msg % (new_version, installed_version))
+            logger.info("New G-HUB version %s is updated successfully...", new_version)
+            self.print_build_info("NEW BUILD INFO")
         else:
-            print("[INFO]: No new update available....")
+            logger.info("No new update available....")
+        self._downloaded = None
         self.app.terminate_all(True)
+        self._launched = False
 
 
 def main():
@@ -248,14 +403,21 @@ def main():
     parser.add_argument('-p', '--password', default='', help="Channel password. Default value is ''")
     parser.add_argument('-t', '--token', default='', help="Channel access token. Default value is ''")
     args = parser.parse_args()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
     updater = GhubUpdater()
     try:
         updater.start(args.channel, args.password, args.token)
-    except Exception as exception:
-        print("[EXCEPTION]: ", exception)
-        print("[WARNING]: There was some problem while updating the G-HUB. Retrying again...")
-        updater.start(args.channel, args.password, args.token)
+    except TERMINAL_ERRORS:
+        raise
+    except RECOVERABLE_ERRORS as exception:
+        logger.error("Exception: %s", exception)
+        logger.warning("There was some problem while updating the G-HUB. Retrying again...")
+        updater.start(args.channel, args.password, args.token, resume=True)
     finally:
+        updater.close()
         updater.app.terminate_all(True)
 
 